@@ -69,17 +69,17 @@ function AdventureCompare() {
       setLoading(true);
       setPairs(null);
       try {
-        const run = async (adventure) => {
-          const chords = [seedToken];
-          for (let i = 0; i < Math.max(0, count - 1); i++) {
-            const { chord } = await modelService.predictNextChord(chords, genre, adventure, section);
-            chords.push(chord);
-          }
-          return chords;
-        };
-        // Sequential keeps the single TF backend calm; generation is ~tens of ms.
-        const safe = await run(SIDES.safe.adventure);
-        const experimental = await run(SIDES.experimental.adventure);
+        // Both sides step together: one batched forward pass per chord position.
+        const safe = [seedToken];
+        const experimental = [seedToken];
+        for (let i = 0; i < Math.max(0, count - 1); i++) {
+          const [safeNext, experimentalNext] = await modelService.predictNextChords([
+            { currentChords: safe, genre, adventure: SIDES.safe.adventure, section },
+            { currentChords: experimental, genre, adventure: SIDES.experimental.adventure, section },
+          ]);
+          safe.push(safeNext.chord);
+          experimental.push(experimentalNext.chord);
+        }
         setPairs({ safe, experimental });
       } catch (error) {
         console.error('A/B generation failed:', error);
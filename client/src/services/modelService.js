@@ -2,6 +2,33 @@ import * as tf from '@tensorflow/tfjs';
 import { Chord, Note, Interval } from '@tonaljs/tonal';
 import { toRomanNumerals as tonalChordListToRoman } from '@tonaljs/progression';
 
+// Model input: [genre, section, c1, c2, c3, c4] — a 4-chord context window.
+const SEQUENCE_LENGTH = 6;
+const MAX_HISTORY = SEQUENCE_LENGTH - 2;
+
+// Hard cap on the sampling nucleus — the top-p cut never looks past this many
+// chords, so high-adventure draws can't wander into the long low-prob tail.
+const TOP_K = 40;
+
+// Indices of the k largest values in descending order (ties keep index order),
+// via a bounded insertion pass instead of sorting the whole vocabulary.
+// `include(i)` can exclude indices from consideration.
+function topKIndices(values, k, include = () => true) {
+  const top = [];
+  for (let i = 0; i < values.length; i++) {
+    if (!include(i)) continue;
+    const v = values[i];
+    if (top.length === k && v <= values[top[k - 1]]) continue;
+    let pos = top.length === k ? k - 1 : top.length;
+    while (pos > 0 && values[top[pos - 1]] < v) {
+      top[pos] = top[pos - 1];
+      pos--;
+    }
+    top[pos] = i;
+  }
+  return top;
+}
+
 class ModelService {
   constructor() {
     this.model = null;
@@ -11,6 +38,7 @@ class ModelService {
     this.sections = [];
     this.chords = [];
     this.specialTokenIds = [];
+    this.inputBuffer = new Int32Array(SEQUENCE_LENGTH);
     this.isLoaded = false;
     this.isLoading = false;
     this.modelPath = '/model/web_model/model.json';
@@ -44,6 +72,11 @@ class ModelService {
     try {
       this.debug('[DEBUG] Starting model and mappings load...');
 
+      // Production builds skip TF.js's per-op correctness checks; dev keeps them.
+      if (!this.debugEnabled) {
+        tf.enableProdMode();
+      }
+
       const [mappingsResponse, model] = await Promise.all([
         fetch(this.mappingsPath),
         tf.loadLayersModel(this.modelPath)
@@ -55,8 +88,10 @@ class ModelService {
 
       this.debug('[DEBUG] Mappings Loaded:', Object.keys(this.mappings).length, 'tokens');
 
-      // Generate reverse mapping
-      this.idToToken = {};
+      // Reverse mapping as a dense array indexed by token id — per-step lookups
+      // walk every id, so array indexing beats string-keyed object access.
+      const maxId = Math.max(...Object.values(this.mappings));
+      this.idToToken = new Array(maxId + 1);
       Object.keys(this.mappings).forEach(token => {
         this.idToToken[this.mappings[token]] = token;
       });
@@ -91,6 +126,13 @@ class ModelService {
         END: this.mappings['<END>']
       });
 
+      // Warm-up pass: the first forward pass pays for backend kernel/shader
+      // compilation, so take that hit here rather than on the first chord.
+      tf.tidy(() => {
+        const dummy = tf.zeros([1, SEQUENCE_LENGTH], 'int32');
+        this.model.apply(dummy, { training: false }).dataSync();
+      });
+
       this.isLoaded = true;
       this.debug('[DEBUG] Model and mappings loaded successfully!');
       return true;
@@ -114,163 +156,207 @@ class ModelService {
    * Use formatChordForDisplay() to convert tokens for UI display.
    */
   async predictNextChord(currentChords, genre, adventure, section = 'any') {
+    const [result] = await this.predictNextChords([{ currentChords, genre, adventure, section }]);
+    return result;
+  }
+
+  /**
+   * Batched predictNextChord: one forward pass for several independent
+   * progressions (e.g. the A/B comparison's safe and experimental runs).
+   * Each request is { currentChords, genre, adventure, section }; results are
+   * { chord, candidates } in request order.
+   */
+  async predictNextChords(requests) {
     if (!this.isLoaded) {
       await this.loadModel();
     }
 
-    this.debug('[DEBUG] ========== predictNextChord ==========');
-    this.debug('[DEBUG] Input:', JSON.stringify({ currentChords, genre, adventure, section }));
+    const contexts = requests.map(({ currentChords, genre, adventure, section = 'any' }) => {
+      this.debug('[DEBUG] ========== predictNextChord ==========');
+      this.debug('[DEBUG] Input:', JSON.stringify({ currentChords, genre, adventure, section }));
+      return this.encodeContext(currentChords, genre, section);
+    });
+
+    // apply() runs the layer graph directly; predict() would add input
+    // validation and batch-slicing overhead on every generation step.
+    // Ids are written into a reused int32 buffer (grown only for larger
+    // batches) — no nested arrays to flatten, no float->int cast in Embedding.
+    // Safe to reuse: the tensor is consumed and disposed synchronously below.
+    const size = contexts.length * SEQUENCE_LENGTH;
+    if (this.inputBuffer.length < size) {
+      this.inputBuffer = new Int32Array(size);
+    }
+    contexts.forEach(({ inputIds }, row) => {
+      this.inputBuffer.set(inputIds, row * SEQUENCE_LENGTH);
+    });
+
+    const probsRows = tf.tidy(() => {
+      const inputTensor = tf.tensor2d(
+        this.inputBuffer.subarray(0, size),
+        [contexts.length, SEQUENCE_LENGTH],
+        'int32'
+      );
+      return this.model.apply(inputTensor, { training: false }).arraySync();
+    });
+
+    return probsRows.map((probsArray, i) =>
+      this.sampleNextChord(probsArray, contexts[i].historyIds, requests[i].adventure)
+    );
+  }
 
-    return tf.tidy(() => {
-      const tokenToInt = this.mappings;
-      const PAD_ID = tokenToInt['<PAD>'] !== undefined ? tokenToInt['<PAD>'] : 14;
-      const START_ID = tokenToInt['<START>'] !== undefined ? tokenToInt['<START>'] : 22;
+  /**
+   * Build the model input ids for one progression.
+   * Returns { inputIds, historyIds } — historyIds is the chord window part.
+   */
+  encodeContext(currentChords, genre, section) {
+    const tokenToInt = this.mappings;
+    const PAD_ID = tokenToInt['<PAD>'] !== undefined ? tokenToInt['<PAD>'] : 14;
+    const START_ID = tokenToInt['<START>'] !== undefined ? tokenToInt['<START>'] : 22;
 
-      // Genre Handling
-      const genreLower = genre ? genre.toLowerCase() : 'pop';
-      const genreToken = `<GENRE=${genreLower}>`;
-      let genreId = tokenToInt[genreToken];
+    // Genre Handling
+    const genreLower = genre ? genre.toLowerCase() : 'pop';
+    const genreToken = `<GENRE=${genreLower}>`;
+    let genreId = tokenToInt[genreToken];
 
-      this.debug('[DEBUG] Genre Token:', genreToken, '-> ID:', genreId);
+    this.debug('[DEBUG] Genre Token:', genreToken, '-> ID:', genreId);
 
+    if (genreId === undefined) {
+      this.debugWarn('[DEBUG] Genre not found! Defaulting to pop.');
+      genreId = tokenToInt['<GENRE=pop>'];
       if (genreId === undefined) {
-        this.debugWarn('[DEBUG] Genre not found! Defaulting to pop.');
-        genreId = tokenToInt['<GENRE=pop>'];
-        if (genreId === undefined) {
-          const firstGenre = Object.keys(tokenToInt).find(k => k.startsWith('<GENRE='));
-          genreId = firstGenre ? tokenToInt[firstGenre] : 1;
-        }
+        const firstGenre = Object.keys(tokenToInt).find(k => k.startsWith('<GENRE='));
+        genreId = firstGenre ? tokenToInt[firstGenre] : 1;
       }
+    }
 
-      // Section Handling — replaces the legacy <START> slot in the input sequence.
-      const sectionLower = section ? section.toLowerCase() : 'any';
-      const sectionToken = `<SECTION=${sectionLower}>`;
-      let sectionId = tokenToInt[sectionToken];
+    // Section Handling — replaces the legacy <START> slot in the input sequence.
+    const sectionLower = section ? section.toLowerCase() : 'any';
+    const sectionToken = `<SECTION=${sectionLower}>`;
+    let sectionId = tokenToInt[sectionToken];
 
-      this.debug('[DEBUG] Section Token:', sectionToken, '-> ID:', sectionId);
+    this.debug('[DEBUG] Section Token:', sectionToken, '-> ID:', sectionId);
 
+    if (sectionId === undefined) {
+      this.debugWarn('[DEBUG] Section not found! Defaulting to any.');
+      sectionId = tokenToInt['<SECTION=any>'];
       if (sectionId === undefined) {
-        this.debugWarn('[DEBUG] Section not found! Defaulting to any.');
-        sectionId = tokenToInt['<SECTION=any>'];
-        if (sectionId === undefined) {
-          const firstSection = Object.keys(tokenToInt).find(k => k.startsWith('<SECTION='));
-          sectionId = firstSection ? tokenToInt[firstSection] : 15;
-        }
+        const firstSection = Object.keys(tokenToInt).find(k => k.startsWith('<SECTION='));
+        sectionId = firstSection ? tokenToInt[firstSection] : 15;
       }
+    }
 
-      // Convert chords to IDs (chords should be in RAW vocabulary format)
-      const chordIds = currentChords.map(chord => {
-        const id = tokenToInt[chord];
-        if (id === undefined) {
-          this.debugWarn('[DEBUG] Chord NOT FOUND in vocab:', chord, '-> Using PAD');
-        } else {
-          this.debug('[DEBUG] Chord:', chord, '-> ID:', id);
-        }
-        return id !== undefined ? id : PAD_ID;
-      });
-
-      // Sequence Construction
-      // Input layout: [genre, section, c1, c2, c3, c4] (length 6, context window = 4 chords)
-      // Training sequences are ['<START>', ...chords] (preprocess_data.py), so the
-      // context must contain <START> while fewer than 4 chords exist — one chord is
-      // [PAD, PAD, START, c1]. Without it the model sees a pattern it was never
-      // trained on and the next-chord distribution collapses to near-uniform.
-      const SEQUENCE_LENGTH = 6;
-      const MAX_HISTORY = SEQUENCE_LENGTH - 2;
-
-      const historyIds = [START_ID, ...chordIds].slice(-MAX_HISTORY);
-      while (historyIds.length < MAX_HISTORY) {
-        historyIds.unshift(PAD_ID);
+    // Convert chords to IDs (chords should be in RAW vocabulary format)
+    const chordIds = currentChords.map(chord => {
+      const id = tokenToInt[chord];
+      if (id === undefined) {
+        this.debugWarn('[DEBUG] Chord NOT FOUND in vocab:', chord, '-> Using PAD');
+      } else {
+        this.debug('[DEBUG] Chord:', chord, '-> ID:', id);
       }
+      return id !== undefined ? id : PAD_ID;
+    });
 
-      const inputIds = [genreId, sectionId, ...historyIds];
-      this.debug('[DEBUG] Final Input IDs:', inputIds);
-      this.debug('[DEBUG] Input Tokens:', inputIds.map(id => this.idToToken[id]));
-
-      const inputTensor = tf.tensor2d([inputIds], [1, SEQUENCE_LENGTH]);
-
-      // Prediction
-      const prediction = this.model.predict(inputTensor);
-      let probabilities = prediction.squeeze();
-      let probsArray = probabilities.arraySync();
-
-      // Find top 5 predictions BEFORE penalty
-      const top5Before = probsArray
-        .map((p, i) => ({ p, i, token: this.idToToken[i] }))
-        .sort((a, b) => b.p - a.p)
-        .slice(0, 5);
-      this.debug('[DEBUG] Top 5 BEFORE Penalty:', top5Before.map(item => `${item.token} (${(item.p * 100).toFixed(2)}%)`));
-
-      // Mask special tokens (<PAD>, <START>, <END>, <GENRE=*>, <SECTION=*>) before
-      // sampling so only real chords can come out — mirrors generate.py. Without
-      // this, sections with high P(<END>) (e.g. bridge) leak into the nucleus.
-      for (const specialId of this.specialTokenIds) {
-        if (specialId < probsArray.length) {
-          probsArray[specialId] = 0;
-        }
-      }
+    // Sequence Construction
+    // Input layout: [genre, section, c1, c2, c3, c4] (length 6, context window = 4 chords)
+    // Training sequences are ['<START>', ...chords] (preprocess_data.py), so the
+    // context must contain <START> while fewer than 4 chords exist — one chord is
+    // [PAD, PAD, START, c1]. Without it the model sees a pattern it was never
+    // trained on and the next-chord distribution collapses to near-uniform.
+    const historyIds = [START_ID, ...chordIds].slice(-MAX_HISTORY);
+    while (historyIds.length < MAX_HISTORY) {
+      historyIds.unshift(PAD_ID);
+    }
 
-      // Repetition Penalty: hard ban on immediate repeat
-      const lastChordId = historyIds[historyIds.length - 1];
-      if (lastChordId !== undefined && lastChordId < probsArray.length && lastChordId !== PAD_ID && lastChordId !== START_ID) {
-        this.debug('[DEBUG] Applying Hard Ban to:', this.idToToken[lastChordId], '(ID:', lastChordId, ')');
-        probsArray[lastChordId] = 0;
-      }
+    const inputIds = [genreId, sectionId, ...historyIds];
+    this.debug('[DEBUG] Final Input IDs:', inputIds);
+    this.debug('[DEBUG] Input Tokens:', inputIds.map(id => this.idToToken[id]));
+
+    return { inputIds, historyIds };
+  }
+
+  /**
+   * Mask, penalize and sample one row of model output.
+   * Returns { chord, candidates } as documented on predictNextChord.
+   */
+  sampleNextChord(probsArray, historyIds, adventure) {
+    const tokenToInt = this.mappings;
+    const PAD_ID = tokenToInt['<PAD>'] !== undefined ? tokenToInt['<PAD>'] : 14;
+    const START_ID = tokenToInt['<START>'] !== undefined ? tokenToInt['<START>'] : 22;
+
+    // Find top 5 predictions BEFORE penalty
+    if (this.debugEnabled) {
+      const top5Before = topKIndices(probsArray, 5);
+      this.debug('[DEBUG] Top 5 BEFORE Penalty:', top5Before.map(i => `${this.idToToken[i]} (${(probsArray[i] * 100).toFixed(2)}%)`));
+    }
 
-      const maskedSum = probsArray.reduce((a, b) => a + b, 0);
-      if (maskedSum > 0) {
-        probsArray = probsArray.map(p => p / maskedSum);
+    // Mask special tokens (<PAD>, <START>, <END>, <GENRE=*>, <SECTION=*>) before
+    // sampling so only real chords can come out — mirrors generate.py. Without
+    // this, sections with high P(<END>) (e.g. bridge) leak into the nucleus.
+    for (const specialId of this.specialTokenIds) {
+      if (specialId < probsArray.length) {
+        probsArray[specialId] = 0;
       }
-      probabilities = tf.tensor1d(probsArray);
-
-      // Find top 5 AFTER penalty
-      const top5After = probsArray
-        .map((p, i) => ({ p, i, token: this.idToToken[i] }))
-        .sort((a, b) => b.p - a.p)
-        .slice(0, 5);
-      this.debug('[DEBUG] Top 5 AFTER Penalty:', top5After.map(item => `${item.token} (${(item.p * 100).toFixed(2)}%)`));
-
-      // Sampling
-      const temperature = 0.2 + (adventure / 100);
-      const topP = 0.9;
-      this.debug('[DEBUG] Sampling Params:', { temperature, topP });
-
-      const predictedId = this.sampleWithTopP(probabilities, topP, temperature);
-      let predictedToken = this.idToToken[predictedId];
-
-      this.debug('[DEBUG] Sampled ID:', predictedId, '-> Token:', predictedToken);
-
-      if (!predictedToken || predictedToken.startsWith('<')) {
-        // Unreachable in practice — special tokens are zeroed before sampling.
-        // Defensive: pick the most probable real chord, not a hardcoded C.
-        this.debugWarn('[DEBUG] Sampled a masked token, falling back to argmax chord');
-        let bestId = -1;
-        for (let i = 0; i < probsArray.length; i++) {
-          const tok = this.idToToken[i];
-          if (tok && !tok.startsWith('<') && (bestId === -1 || probsArray[i] > probsArray[bestId])) {
-            bestId = i;
-          }
+    }
+
+    // Repetition Penalty: hard ban on immediate repeat
+    const lastChordId = historyIds[historyIds.length - 1];
+    if (lastChordId !== undefined && lastChordId < probsArray.length && lastChordId !== PAD_ID && lastChordId !== START_ID) {
+      this.debug('[DEBUG] Applying Hard Ban to:', this.idToToken[lastChordId], '(ID:', lastChordId, ')');
+      probsArray[lastChordId] = 0;
+    }
+
+    const maskedSum = probsArray.reduce((a, b) => a + b, 0);
+    if (maskedSum > 0) {
+      probsArray = probsArray.map(p => p / maskedSum);
+    }
+
+    // Find top 5 AFTER penalty
+    if (this.debugEnabled) {
+      const top5After = topKIndices(probsArray, 5);
+      this.debug('[DEBUG] Top 5 AFTER Penalty:', top5After.map(i => `${this.idToToken[i]} (${(probsArray[i] * 100).toFixed(2)}%)`));
+    }
+
+    // Sampling
+    const temperature = 0.2 + (adventure / 100);
+    const topP = 0.9;
+    this.debug('[DEBUG] Sampling Params:', { temperature, topP, topK: TOP_K });
+
+    const predictedId = this.sampleWithTopP(probsArray, topP, temperature, TOP_K);
+    let predictedToken = this.idToToken[predictedId];
+
+    this.debug('[DEBUG] Sampled ID:', predictedId, '-> Token:', predictedToken);
+
+    if (!predictedToken || predictedToken.startsWith('<')) {
+      // Unreachable in practice — special tokens are zeroed before sampling.
+      // Defensive: pick the most probable real chord, not a hardcoded C.
+      this.debugWarn('[DEBUG] Sampled a masked token, falling back to argmax chord');
+      let bestId = -1;
+      for (let i = 0; i < probsArray.length; i++) {
+        const tok = this.idToToken[i];
+        if (tok && !tok.startsWith('<') && (bestId === -1 || probsArray[i] > probsArray[bestId])) {
+          bestId = i;
         }
-        predictedToken = bestId >= 0 ? this.idToToken[bestId] : 'C';
       }
+      predictedToken = bestId >= 0 ? this.idToToken[bestId] : 'C';
+    }
 
-      // Interpretability data: top real-chord candidates from the final
-      // (masked, renormalized) distribution. The sampled chord is guaranteed
-      // present so the UI can always mark which one the model actually chose.
-      const candidates = probsArray
-        .map((prob, i) => ({ token: this.idToToken[i], prob }))
-        .filter(({ token }) => token && !token.startsWith('<'))
-        .sort((a, b) => b.prob - a.prob)
-        .slice(0, 5);
-      if (!candidates.some(c => c.token === predictedToken)) {
-        candidates.push({ token: predictedToken, prob: probsArray[predictedId] || 0 });
-      }
+    // Interpretability data: top real-chord candidates from the final
+    // (masked, renormalized) distribution. The sampled chord is guaranteed
+    // present so the UI can always mark which one the model actually chose.
+    const isChord = (i) => {
+      const token = this.idToToken[i];
+      return Boolean(token) && !token.startsWith('<');
+    };
+    const candidates = topKIndices(probsArray, 5, isChord)
+      .map(i => ({ token: this.idToToken[i], prob: probsArray[i] }));
+    if (!candidates.some(c => c.token === predictedToken)) {
+      candidates.push({ token: predictedToken, prob: probsArray[predictedId] || 0 });
+    }
 
-      // Return RAW token (not formatted) - this is critical for proper lookups
-      this.debug('[DEBUG] Final Output (RAW):', predictedToken);
-      this.debug('[DEBUG] ==========================================');
-      return { chord: predictedToken, candidates };
-    });
+    // Return RAW token (not formatted) - this is critical for proper lookups
+    this.debug('[DEBUG] Final Output (RAW):', predictedToken);
+    this.debug('[DEBUG] ==========================================');
+    return { chord: predictedToken, candidates };
   }
 
   /**
@@ -381,18 +467,31 @@ class ModelService {
     return chords.map((c) => this.transposeChord(c, semitones));
   }
 
-  sampleWithTopP(probabilities, topP, temperature) {
-    const probs = probabilities.arraySync();
-    const temp = Math.max(temperature, 0.01);
-    const logits = probs.map(p => Math.log(p + 1e-10) / temp);
-    const maxLogit = Math.max(...logits);
-    const expLogits = logits.map(l => Math.exp(l - maxLogit));
-    const sumExp = expLogits.reduce((a, b) => a + b, 0);
-    const scaledProbs = expLogits.map(e => e / sumExp);
-
-    const sortedIndices = scaledProbs
-      .map((p, i) => ({ p, i }))
-      .sort((a, b) => b.p - a.p);
+  /**
+   * Temperature + top-k/nucleus sampling over a plain probability array.
+   * softmax(log(p) / T) is computed as (p / pMax)^(1/T) normalized — one pow
+   * per entry instead of separate log, exp and max passes. Only the top `topK`
+   * entries are ranked; the top-p cut is applied within them.
+   */
+  sampleWithTopP(probs, topP, temperature, topK = probs.length) {
+    const invTemp = 1 / Math.max(temperature, 0.01);
+    let maxProb = 0;
+    for (let i = 0; i < probs.length; i++) {
+      if (probs[i] > maxProb) maxProb = probs[i];
+    }
+    const scaledProbs = new Float64Array(probs.length);
+    let sumExp = 0;
+    for (let i = 0; i < probs.length; i++) {
+      const e = Math.pow((probs[i] + 1e-10) / (maxProb + 1e-10), invTemp);
+      scaledProbs[i] = e;
+      sumExp += e;
+    }
+    for (let i = 0; i < scaledProbs.length; i++) {
+      scaledProbs[i] /= sumExp;
+    }
+
+    const sortedIndices = topKIndices(scaledProbs, topK)
+      .map(i => ({ p: scaledProbs[i], i }));
 
     let cumulativeSum = 0;
     const topIndices = [];